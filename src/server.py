@@ -1,9 +1,14 @@
 import asyncio
+import importlib
 import logging
+import os
 from typing import Any, Sequence
-import json
 import urllib.parse
 import re
+import contextlib
+import threading
+from html import unescape
+from concurrent.futures import ThreadPoolExecutor
 
 from mcp.server import Server
 from mcp.server.sse import SseServerTransport
@@ -11,8 +16,9 @@ import mcp.types as types
 
 # Local web scraping and content extraction
 import httpx
-from bs4 import BeautifulSoup
-import trafilatura
+from selectolax.lexbor import LexborHTMLParser
+from cachetools import TTLCache
+import diskcache
 
 # Configure logging with more detail
 logging.basicConfig(
@@ -27,52 +33,181 @@ server = Server("web-search")
 # Initialize SSE Transport
 sse_transport = SseServerTransport("/messages")
 
-def extract_page_content(url: str, timeout: float = 10.0) -> dict:
-    """Extract main content from a web page using trafilatura.
+# Browser-like User-Agent sent with every request
+_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+_HEADERS = {'User-Agent': _UA}
+
+# Initialize shared HTTP client (connection pool reused across searches)
+http_client = httpx.AsyncClient(
+    headers=_HEADERS,
+    timeout=10.0,
+    follow_redirects=True,
+    http2=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+)
+
+# Only the start of a page is needed for an 800 character summary
+_MAX_BODY_BYTES = 256 * 1024
+# Pages announcing a larger body are skipped without downloading
+_MAX_CONTENT_LENGTH = 2 * 1024 * 1024
+
+# Links to these files are not fetched; trafilatura cannot use them
+_BINARY_EXTENSIONS = ('.pdf', '.zip', '.tar', '.gz', '.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3')
+# Returned instead of page content for binary / non-HTML links
+_NON_HTML_RESULT = {'title': None, 'description': '', 'content': '(not an HTML page)'}
+
+# Overall time budget for fetching all result pages of one search; pages
+# still loading after it are dropped so one slow site cannot stall the reply
+_EXTRACTION_DEADLINE = 6.0
+
+# Limits concurrent page fetches per host to stay clear of rate limiting (429).
+# Maps host -> [semaphore, users]; an entry is dropped once no fetch holds or
+# waits for it, so only hosts being fetched right now are kept
+_host_semaphores: dict[str, list] = {}
+
+# Extracted page content by URL (pages change, so entries expire after an hour)
+_content_cache = TTLCache(maxsize=1024, ttl=3600)
+
+# Formatted results by search parameters, shared across server restarts;
+# repeated tool calls within a few minutes skip the whole pipeline.
+# Opened on first use (see _get_query_cache). SQLite calls block, so the
+# cache is only used from worker threads, and a locked database is given
+# up on after a second instead of diskcache's default minute
+_query_cache = None
+_query_cache_lock = threading.Lock()
+_QUERY_CACHE_TTL = 300
+_QUERY_CACHE_SIZE = 256 * 1024 * 1024
+_QUERY_CACHE_TIMEOUT = 1.0
+
+# DDG result links are plain <a class="result__a" href="..."> tags, so they
+# are matched directly in the HTML; the CSS selector is the parsing fallback
+_RESULT_LINK_RE = re.compile(r'<a[^>]+class="result__a"[^>]+href="([^"]+)"[^>]*>(.*?)</a>', re.S)
+_TAG_RE = re.compile(r'<[^>]+>')
+# DDG wraps each search result in div.result with the link in a.result__a
+_RESULT_SELECTOR = 'div.result a.result__a'
+# Result links point to a DDG redirect carrying the target in the uddg parameter
+_UDDG_RE = re.compile(r'[?&]uddg=([^&]+)')
+
+# trafilatura is slow to import, so it is loaded on first use
+_trafilatura = None
+
+def _load_trafilatura():
+    """Import trafilatura on first use and return the module."""
+    global _trafilatura
+    if _trafilatura is None:
+        _trafilatura = importlib.import_module('trafilatura')
+    return _trafilatura
+
+def parse_page_content(html: str) -> dict:
+    """Extract main content from page HTML using trafilatura.
+    
+    The HTML is parsed into a single lxml tree that is shared by trafilatura
+    and the fallback used when trafilatura finds no main content.
     
     Returns dict with: title, description, content (main text)
     """
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    trafilatura = _load_trafilatura()
+    tree = trafilatura.load_html(html)
+    if tree is None:
+        return {'title': 'No title', 'description': '', 'content': ''}
+    
+    # trafilatura works on its own copy, so the tree stays intact for the fallback
+    document = trafilatura.bare_extraction(
+        tree,
+        include_comments=False,
+        include_tables=False,
+        with_metadata=True
+    )
+    
+    if document is not None:
+        return {
+            'title': document.title,
+            'description': (document.description or '')[:300],  # First 300 chars
+            'content': (document.text or '')[:800]  # First 800 chars of main content
         }
-        
-        with httpx.Client(timeout=timeout, follow_redirects=True) as client:
-            response = client.get(url, headers=headers)
+    
+    # Fallback: read title, meta description and first paragraphs from the tree
+    title = tree.findtext('.//title')
+    meta_desc = tree.xpath('.//meta[@name="description"]/@content')
+    
+    # Get first paragraphs, stopping once the 800 character budget is filled
+    parts, length = [], 0
+    for p in tree.iter('p'):
+        text = p.text_content().strip()
+        parts.append(text)
+        length += len(text) + 1
+        if length >= 800 or len(parts) == 3:
+            break
+    content = ' '.join(parts)[:800]
+    
+    return {
+        'title': title.strip() if title else 'No title',
+        'description': meta_desc[0][:300] if meta_desc else '',
+        'content': content
+    }
+
+@contextlib.asynccontextmanager
+async def _host_slot(host: str):
+    """Hold one of the two concurrent fetch slots of the given host."""
+    entry = _host_semaphores.get(host)
+    if entry is None:
+        entry = _host_semaphores[host] = [asyncio.Semaphore(2), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _host_semaphores[host]
+
+async def extract_page_content(client: httpx.AsyncClient, url: str, timeout: float = 4.0) -> dict:
+    """Fetch a web page and extract its main content.
+    
+    The page is fetched with the given client so that concurrent extractions
+    share its connection pool; at most two fetches per host run at a time.
+    Only the first 256KB of the body is read, and binary / non-HTML links
+    are skipped.
+    Successful extractions are cached by URL for an hour; failures are not.
+    
+    Returns dict with: title, description, content (main text)
+    """
+    cached = _content_cache.get(url)
+    if cached is not None:
+        logger.debug(f"Content cache hit for {url}")
+        return cached
+    
+    url_parts = urllib.parse.urlsplit(url)
+    if url_parts.path.lower().endswith(_BINARY_EXTENSIONS):
+        logger.info(f"Skipping non-HTML URL: {url}")
+        return dict(_NON_HTML_RESULT)
+    
+    try:
+        async with _host_slot(url_parts.netloc), client.stream('GET', url, timeout=timeout) as response:
             response.raise_for_status()
-            html = response.text
-        
-        # Extract main content using trafilatura
-        extracted = trafilatura.extract(
-            html,
-            include_comments=False,
-            include_tables=False,
-            with_metadata=True,
-            output_format='json'
-        )
-        
-        if extracted:
-            data = json.loads(extracted)
-            return {
-                'title': data.get('title', 'No title'),
-                'description': data.get('description', '')[:300],  # First 300 chars
-                'content': data.get('text', '')[:800]  # First 800 chars of main content
-            }
-        
-        # Fallback: use BeautifulSoup
-        soup = BeautifulSoup(html, 'html.parser')
-        title = soup.find('title')
-        meta_desc = soup.find('meta', {'name': 'description'})
-        
-        # Get first paragraph
-        paragraphs = soup.find_all('p')
-        content = ' '.join([p.get_text(strip=True) for p in paragraphs[:3]])[:800]
+            
+            content_type = response.headers.get('content-type', '').lower()
+            if content_type and 'html' not in content_type:
+                logger.info(f"Skipping non-HTML content ({content_type}): {url}")
+                return dict(_NON_HTML_RESULT)
+            
+            content_length = int(response.headers.get('content-length', 0))
+            if content_length > _MAX_CONTENT_LENGTH:
+                raise ValueError(f"Page too large ({content_length} bytes)")
+            
+            # Read at most _MAX_BODY_BYTES of the body
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) >= _MAX_BODY_BYTES:
+                    break
+            
+            html = bytes(body[:_MAX_BODY_BYTES]).decode(
+                response.charset_encoding or 'utf-8', errors='replace'
+            )
         
-        return {
-            'title': title.get_text(strip=True) if title else 'No title',
-            'description': meta_desc.get('content', '')[:300] if meta_desc else '',
-            'content': content
-        }
+        # Parsing is CPU bound, keep it off the event loop
+        content_data = await asyncio.to_thread(parse_page_content, html)
         
     except Exception as e:
         logger.warning(f"Failed to extract content from {url}: {e}")
@@ -81,6 +216,98 @@ def extract_page_content(url: str, timeout: float = 10.0) -> dict:
             'description': '',
             'content': f'Error: {str(e)[:200]}'
         }
+    
+    _content_cache[url] = content_data
+    return content_data
+
+def _iter_result_links(html: str):
+    """Yield (href, title) for each DuckDuckGo result link in page order."""
+    found = False
+    for match in _RESULT_LINK_RE.finditer(html):
+        found = True
+        title = _TAG_RE.sub('', match.group(2))
+        yield unescape(match.group(1)), unescape(title).strip()
+    
+    if not found:
+        # Markup no longer matches the regex: fall back to a full parse
+        for link_tag in LexborHTMLParser(html).css(_RESULT_SELECTOR):
+            href = link_tag.attributes.get('href')
+            if href:
+                yield href, link_tag.text(strip=True)
+
+def parse_search_results(html: str, max_results: int) -> list[dict]:
+    """Parse DuckDuckGo HTML search results.
+    
+    Duplicate URLs are dropped, so each page is fetched only once.
+    
+    Returns list of dicts with: url, title
+    """
+    results = []
+    seen = set()
+    
+    for href_raw, title in _iter_result_links(html):
+        if len(results) >= max_results:
+            break
+        
+        # Extract actual URL from DDG redirect (uddg parameter)
+        m = _UDDG_RE.search(href_raw)
+        url = urllib.parse.unquote(m.group(1)) if m else href_raw
+        
+        # Skip non-http links and mirrored entries
+        if not url.startswith('http') or url in seen:
+            continue
+        seen.add(url)
+        
+        results.append({
+            'url': url,
+            'title': title
+        })
+    
+    return results
+
+def _query_cache_dir() -> str:
+    """Return the query cache directory.
+    
+    WEBSEARCHMCP_CACHE_DIR overrides the default per-user cache directory
+    ($XDG_CACHE_HOME or ~/.cache).
+    """
+    configured = os.environ.get('WEBSEARCHMCP_CACHE_DIR')
+    if configured:
+        return configured
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'websearchmcp')
+
+def _get_query_cache() -> diskcache.Cache:
+    """Open the query cache on first use and return it."""
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            directory = _query_cache_dir()
+            # Private to the current user, the cache unpickles what it reads
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            _query_cache = diskcache.Cache(
+                directory,
+                size_limit=_QUERY_CACHE_SIZE,
+                timeout=_QUERY_CACHE_TIMEOUT
+            )
+        return _query_cache
+
+async def _query_cache_get(key: str) -> str | None:
+    """Return cached search results, or None when missing or the cache fails."""
+    try:
+        return await asyncio.to_thread(lambda: _get_query_cache().get(key))
+    except Exception as e:
+        logger.warning(f"Query cache lookup failed, searching without it: {e}")
+        return None
+
+async def _query_cache_set(key: str, value: str) -> None:
+    """Store search results; a failing cache only loses the entry."""
+    try:
+        await asyncio.to_thread(
+            lambda: _get_query_cache().set(key, value, expire=_QUERY_CACHE_TTL)
+        )
+    except Exception as e:
+        logger.warning(f"Failed to cache search results: {e}")
 
 async def perform_search(query: str, max_results: int = 5, region: str = "wt-wt", timelimit: str | None = None) -> str:
     """Fully local search: scrape Google/DuckDuckGo + extract actual page content.
@@ -97,85 +324,61 @@ async def perform_search(query: str, max_results: int = 5, region: str = "wt-wt"
     logger.info(f"Region: {region}")
     logger.info(f"Time limit: {timelimit}")
     
+    cache_key = f"{query}|{max_results}|{region}|{timelimit}"
+    
     try:
-        def _search_and_extract():
-            # Step 1: Scrape search results from DuckDuckGo HTML (simpler than Google)
-            encoded_query = urllib.parse.quote_plus(query)
-            search_url = f"https://html.duckduckgo.com/html/?q={encoded_query}"
-            
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            
-            logger.info(f"Scraping search results from: {search_url}")
+        cached = await _query_cache_get(cache_key)
+        if cached is not None:
+            logger.info("Returning cached search results")
+            return cached
+        
+        # Step 1: Scrape search results from DuckDuckGo HTML (simpler than Google)
+        encoded_query = urllib.parse.quote_plus(query)
+        search_url = f"https://html.duckduckgo.com/html/?q={encoded_query}"
+        
+        logger.info(f"Scraping search results from: {search_url}")
+        
+        response = await http_client.get(search_url, timeout=15.0)
+        response.raise_for_status()
+        
+        search_results = parse_search_results(response.text, max_results)
+        logger.info(f"Found {len(search_results)} search results")
+        
+        # Step 2: Extract content from all result pages concurrently
+        tasks = []
+        for result in search_results:
+            logger.info(f"Extracting content from: {result['url']}")
+            tasks.append(asyncio.create_task(extract_page_content(http_client, result['url'])))
+        
+        done = set()
+        try:
+            if tasks:
+                done, _ = await asyncio.wait(tasks, timeout=_EXTRACTION_DEADLINE)
+        finally:
+            # Drop pages that missed the deadline (no-op for finished tasks)
+            for task in tasks:
+                task.cancel()
+        
+        results = []
+        for result, task in zip(search_results, tasks):
+            if task in done:
+                content_data = task.result()
+            else:
+                logger.warning(f"Content extraction timed out for: {result['url']}")
+                content_data = {
+                    'title': result['title'],
+                    'description': '',
+                    'content': '(timeout)'
+                }
             
-            with httpx.Client(timeout=15.0, follow_redirects=True) as client:
-                response = client.get(search_url, headers=headers)
-                response.raise_for_status()
-                
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Parse DuckDuckGo HTML search results
-                results = []
-                
-                # DDG uses div.result for each search result
-                result_divs = soup.find_all('div', class_='result')
-                
-                for div in result_divs[:max_results]:
-                    try:
-                        # Extract link
-                        link_tag = div.find('a', class_='result__a')
-                        if not link_tag or not link_tag.get('href'):
-                            continue
-                        
-                        # DDG uses uddg parameter, need to decode
-                        href_raw = link_tag['href']
-                        
-                        # Extract actual URL from DDG redirect
-                        if 'uddg=' in href_raw:
-                            # Parse URL parameters properly
-                            parsed = urllib.parse.urlparse(href_raw)
-                            params = urllib.parse.parse_qs(parsed.query)
-                            url = params.get('uddg', [''])[0]
-                        else:
-                            url = href_raw
-                        
-                        # Skip non-http links
-                        if not url.startswith('http'):
-                            continue
-                        
-                        # Extract title
-                        title = link_tag.get_text(strip=True) if link_tag else 'No title'
-                        
-                        results.append({
-                            'url': url,
-                            'title': title
-                        })
-                        
-                    except Exception as e:
-                        logger.warning(f"Error parsing search result: {e}")
-                        continue
-                
-                logger.info(f"Found {len(results)} search results")
-                
-                # Step 2: Extract content from each result page
-                enriched_results = []
-                for result in results:
-                    logger.info(f"Extracting content from: {result['url']}")
-                    content_data = extract_page_content(result['url'])
-                    
-                    enriched_results.append({
-                        'url': result['url'],
-                        'title': content_data['title'] or result['title'],
-                        'description': content_data['description'],
-                        'content': content_data['content']
-                    })
-                
-                logger.info(f"Successfully extracted content from {len(enriched_results)} pages")
-                return enriched_results
+            results.append({
+                'url': result['url'],
+                'title': content_data['title'] or result['title'],
+                'description': content_data['description'],
+                'content': content_data['content']
+            })
         
-        loop = asyncio.get_running_loop()
-        results = await loop.run_in_executor(None, _search_and_extract)
+        logger.info(f"Successfully extracted content from {len(results)} pages")
         
         if not results:
             logger.warning("No results found!")
@@ -198,6 +401,9 @@ async def perform_search(query: str, max_results: int = 5, region: str = "wt-wt"
         
         final_result = "\n---\n\n".join(formatted_results)
         logger.info(f"Returning {len(formatted_results)} formatted results with content")
+        
+        # Errors and empty results return earlier, so only real results are cached
+        await _query_cache_set(cache_key, final_result)
         return final_result
         
     except Exception as e:
@@ -286,9 +492,40 @@ async def handle_call_tool(
     logger.error(f"Unknown tool requested: {name}")
     raise ValueError(f"Unknown tool: {name}")
 
+async def handle_lifespan(receive, send):
+    """Handle ASGI lifespan events.
+    
+    Sizes the parser thread pool on startup and closes the shared HTTP client
+    and the query cache on shutdown.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Page parsing runs in the default executor (see extract_page_content)
+            loop = asyncio.get_running_loop()
+            # asyncio has no public getter; an executor already created by an
+            # earlier to_thread call is shut down instead of being leaked
+            previous_executor = getattr(loop, '_default_executor', None)
+            loop.set_default_executor(
+                ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2))
+            )
+            if previous_executor is not None:
+                previous_executor.shutdown(wait=False)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await http_client.aclose()
+            if _query_cache is not None:
+                _query_cache.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
 # Pure ASGI application
 async def app(scope, receive, send):
     """Raw ASGI application for MCP SSE transport."""
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+        return
+    
     if scope["type"] != "http":
         return
     
@@ -0,0 +1,61 @@
+"""
+Shared fixtures for Web Search MCP Server tests.
+"""
+import asyncio
+import copy
+import pytest
+from unittest.mock import AsyncMock
+import sys
+import os
+
+# Add src to path (once for the whole test session)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import server
+
+
+@pytest.fixture(scope="session")
+def server_mod():
+    """The imported server module."""
+    return server
+
+
+@pytest.fixture(scope="session")
+def _mock_search_proto():
+    """Prototype perform_search mock, built once and copied per test."""
+    return AsyncMock(return_value="Mocked search results")
+
+
+@pytest.fixture
+def mock_search(_mock_search_proto, server_mod, monkeypatch):
+    """Replace server.perform_search with a fresh copy of the prototype mock."""
+    mock = copy.copy(_mock_search_proto)
+    mock.reset_mock()
+    monkeypatch.setattr(server_mod, 'perform_search', mock)
+    return mock
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """Single event loop shared by the whole test session."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+async def tools_list(server_mod):
+    """Tools returned by handle_list_tools, listed once per session."""
+    return await server_mod.handle_list_tools()
+
+
+@pytest.fixture(scope="session")
+def tools_by_name(tools_list):
+    """Listed tools keyed by name."""
+    return {tool.name: tool for tool in tools_list}
+
+
+@pytest.fixture(scope="session")
+def search_tool(tools_by_name):
+    """The search_web tool definition."""
+    return tools_by_name['search_web']
@@ -2,23 +2,41 @@
 Tests for content extraction functionality.
 """
 import pytest
-from unittest.mock import Mock, patch
+import asyncio
+from unittest.mock import Mock, MagicMock, patch
 import httpx
-from bs4 import BeautifulSoup
-import sys
-import os
-
-# Add src to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
+import server
 from server import extract_page_content
 
 
+def make_client(html, headers=None):
+    """Create a mocked async HTTP client streaming the given HTML."""
+    async def aiter_bytes():
+        yield html.encode('utf-8')
+    
+    mock_response = Mock()
+    mock_response.headers = headers or {}
+    mock_response.charset_encoding = 'utf-8'
+    mock_response.raise_for_status = Mock()
+    mock_response.aiter_bytes = aiter_bytes
+    
+    mock_client = MagicMock()
+    mock_client.stream.return_value.__aenter__.return_value = mock_response
+    return mock_client
+
+
+@pytest.fixture(autouse=True)
+def clear_content_cache():
+    """Start every test with an empty content cache."""
+    server._content_cache.clear()
+
+
 @pytest.mark.unit
 class TestContentExtraction:
     """Test suite for extract_page_content function."""
     
-    def test_successful_extraction_with_trafilatura(self):
+    async def test_successful_extraction_with_trafilatura(self):
         """Test successful content extraction using trafilatura."""
         mock_html = """
         <html>
@@ -32,30 +50,25 @@ class TestContentExtraction:
         </html>
         """
         
-        mock_json = {
+        document_fields = {
             'title': 'Test Article',
             'description': 'Test description',
             'text': 'Main Title. This is the main content of the article.'
         }
         
-        with patch('httpx.Client') as mock_client:
-            mock_response = Mock()
-            mock_response.text = mock_html
-            mock_response.raise_for_status = Mock()
-            mock_client.return_value.__enter__.return_value.get.return_value = mock_response
-            
-            with patch('server.trafilatura.extract') as mock_extract:
-                import json
-                mock_extract.return_value = json.dumps(mock_json)
-                
-                result = extract_page_content('https://example.com/article')
-                
-                assert result['title'] == 'Test Article'
-                assert result['description'] == 'Test description'
-                assert 'main content' in result['content']
-    
-    def test_fallback_to_beautifulsoup(self):
-        """Test fallback to BeautifulSoup when trafilatura fails."""
+        mock_client = make_client(mock_html)
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = Mock(**document_fields)
+            
+            result = await extract_page_content(mock_client, 'https://example.com/article')
+            
+            assert result['title'] == 'Test Article'
+            assert result['description'] == 'Test description'
+            assert 'main content' in result['content']
+    
+    async def test_fallback_without_trafilatura_content(self):
+        """Test fallback to the parsed HTML tree when trafilatura fails."""
         mock_html = """
         <html>
             <head>
@@ -69,93 +82,259 @@ class TestContentExtraction:
         </html>
         """
         
-        with patch('httpx.Client') as mock_client:
-            mock_response = Mock()
-            mock_response.text = mock_html
-            mock_response.raise_for_status = Mock()
-            mock_client.return_value.__enter__.return_value.get.return_value = mock_response
-            
-            with patch('server.trafilatura.extract') as mock_extract:
-                mock_extract.return_value = None  # Simulate trafilatura failure
-                
-                result = extract_page_content('https://example.com/test')
-                
-                assert result['title'] == 'Fallback Test'
-                assert 'Fallback description' in result['description']
-                assert 'First paragraph' in result['content']
-    
-    def test_http_error_handling(self):
-        """Test proper error handling for HTTP errors."""
-        with patch('httpx.Client') as mock_client:
-            mock_client.return_value.__enter__.return_value.get.side_effect = httpx.HTTPStatusError(
-                "404 Not Found",
-                request=Mock(),
-                response=Mock(status_code=404)
-            )
+        mock_client = make_client(mock_html)
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = None  # Simulate trafilatura failure
             
-            result = extract_page_content('https://example.com/notfound')
+            result = await extract_page_content(mock_client, 'https://example.com/test')
             
-            assert result['title'] == 'Content extraction failed'
-            assert 'Error' in result['content']
+            assert result['title'] == 'Fallback Test'
+            assert 'Fallback description' in result['description']
+            assert 'First paragraph' in result['content']
+            
+            # trafilatura received the already parsed tree, not the raw HTML
+            assert mock_extract.call_args[0][0].tag == 'html'
     
-    def test_timeout_handling(self):
+    async def test_http_error_handling(self):
+        """Test proper error handling for HTTP errors."""
+        mock_client = MagicMock()
+        mock_client.stream.side_effect = httpx.HTTPStatusError(
+            "404 Not Found",
+            request=Mock(),
+            response=Mock(status_code=404)
+        )
+        
+        result = await extract_page_content(mock_client, 'https://example.com/notfound')
+        
+        assert result['title'] == 'Content extraction failed'
+        assert 'Error' in result['content']
+    
+    async def test_timeout_handling(self):
         """Test proper handling of request timeouts."""
-        with patch('httpx.Client') as mock_client:
-            mock_client.return_value.__enter__.return_value.get.side_effect = httpx.TimeoutException(
-                "Request timed out"
-            )
-            
-            result = extract_page_content('https://example.com/slow', timeout=1.0)
-            
-            assert result['title'] == 'Content extraction failed'
-            assert 'Error' in result['content']
+        mock_client = MagicMock()
+        mock_client.stream.side_effect = httpx.TimeoutException(
+            "Request timed out"
+        )
+        
+        result = await extract_page_content(mock_client, 'https://example.com/slow', timeout=1.0)
+        
+        assert result['title'] == 'Content extraction failed'
+        assert 'Error' in result['content']
     
-    def test_description_truncation(self):
+    async def test_description_truncation(self):
         """Test that description is truncated to 300 characters."""
         long_description = "x" * 500
-        mock_json = {
+        document_fields = {
             'title': 'Test',
             'description': long_description,
             'text': 'Content'
         }
         
-        mock_html = "<html><body>test</body></html>"
+        mock_client = make_client("<html><body>test</body></html>")
         
-        with patch('httpx.Client') as mock_client:
-            mock_response = Mock()
-            mock_response.text = mock_html
-            mock_response.raise_for_status = Mock()
-            mock_client.return_value.__enter__.return_value.get.return_value = mock_response
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = Mock(**document_fields)
+            
+            result = await extract_page_content(mock_client, 'https://example.com')
             
-            with patch('server.trafilatura.extract') as mock_extract:
-                import json
-                mock_extract.return_value = json.dumps(mock_json)
-                
-                result = extract_page_content('https://example.com')
-                
-                assert len(result['description']) == 300
+            assert len(result['description']) == 300
     
-    def test_content_truncation(self):
+    async def test_content_truncation(self):
         """Test that content is truncated to 800 characters."""
         long_content = "y" * 1000
-        mock_json = {
+        document_fields = {
             'title': 'Test',
             'description': 'Desc',
             'text': long_content
         }
         
-        mock_html = "<html><body>test</body></html>"
-        
-        with patch('httpx.Client') as mock_client:
-            mock_response = Mock()
-            mock_response.text = mock_html
-            mock_response.raise_for_status = Mock()
-            mock_client.return_value.__enter__.return_value.get.return_value = mock_response
-            
-            with patch('server.trafilatura.extract') as mock_extract:
-                import json
-                mock_extract.return_value = json.dumps(mock_json)
-                
-                result = extract_page_content('https://example.com')
-                
-                assert len(result['content']) == 800
+        mock_client = make_client("<html><body>test</body></html>")
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = Mock(**document_fields)
+            
+            result = await extract_page_content(mock_client, 'https://example.com')
+            
+            assert len(result['content']) == 800
+    
+    async def test_fallback_content_truncation(self):
+        """Test that fallback content stops at 800 characters and 3 paragraphs."""
+        mock_client = make_client(
+            "<html><body><p>" + "a" * 900 + "</p><p>Second</p></body></html>"
+        )
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = None
+            
+            result = await extract_page_content(mock_client, 'https://example.com/long')
+            
+            assert result['content'] == "a" * 800
+        
+        mock_client = make_client(
+            "<html><body>" + "".join(f"<p>Paragraph {i}</p>" for i in range(5)) + "</body></html>"
+        )
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = None
+            
+            result = await extract_page_content(mock_client, 'https://example.com/short')
+            
+            assert result['content'] == "Paragraph 0 Paragraph 1 Paragraph 2"
+    
+    async def test_body_size_cap(self):
+        """Test that only the first 256KB of the page body is parsed."""
+        mock_html = "<html><body><p>" + "z" * (1024 * 1024) + "</p></body></html>"
+        
+        mock_client = make_client(mock_html)
+        
+        with patch('server.parse_page_content') as mock_parse:
+            mock_parse.return_value = {'title': 'Huge', 'description': '', 'content': ''}
+            
+            await extract_page_content(mock_client, 'https://example.com/huge')
+            
+            parsed_html = mock_parse.call_args[0][0]
+            assert len(parsed_html) == 256 * 1024
+    
+    async def test_content_length_too_large(self):
+        """Test that pages announcing a body over 2MB are skipped."""
+        mock_client = make_client(
+            "<html><body><p>Big page</p></body></html>",
+            headers={'content-length': str(3 * 1024 * 1024)}
+        )
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            result = await extract_page_content(mock_client, 'https://example.com/big')
+            
+            mock_extract.assert_not_called()
+            assert result['title'] == 'Content extraction failed'
+            assert 'too large' in result['content']
+    
+    async def test_binary_url_is_skipped(self):
+        """Test that links to binary files are not fetched."""
+        mock_client = make_client("")
+        
+        result = await extract_page_content(mock_client, 'https://example.com/report.PDF?download=1')
+        
+        mock_client.stream.assert_not_called()
+        assert result['content'] == '(not an HTML page)'
+    
+    async def test_non_html_content_type_is_skipped(self):
+        """Test that non-HTML responses are not parsed."""
+        mock_client = make_client("%PDF-1.7", headers={'content-type': 'application/pdf'})
+        
+        with patch('server.parse_page_content') as mock_parse:
+            result = await extract_page_content(mock_client, 'https://example.com/download')
+            
+            mock_parse.assert_not_called()
+            assert result['content'] == '(not an HTML page)'
+    
+    async def test_mixed_case_html_content_type_is_parsed(self):
+        """Test that the Content-Type check ignores case."""
+        mock_client = make_client(
+            "<html><body><p>Text</p></body></html>",
+            headers={'content-type': 'Text/HTML; charset=utf-8'}
+        )
+        
+        with patch('server.parse_page_content') as mock_parse:
+            mock_parse.return_value = {'title': 'Mixed', 'description': '', 'content': 'Text'}
+            
+            result = await extract_page_content(mock_client, 'https://example.com/mixed')
+            
+            mock_parse.assert_called_once()
+            assert result['content'] == 'Text'
+    
+    async def test_fetches_per_host_are_limited(self):
+        """Test that at most two pages of one host are fetched at a time."""
+        mock_client = make_client("<html><body><p>Text</p></body></html>")
+        mock_response = mock_client.stream.return_value.__aenter__.return_value
+        active = peak = 0
+        
+        async def enter_stream():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            return mock_response
+        
+        async def exit_stream(*args):
+            nonlocal active
+            active -= 1
+        
+        mock_client.stream.return_value.__aenter__.side_effect = enter_stream
+        mock_client.stream.return_value.__aexit__.side_effect = exit_stream
+        
+        with patch('server.parse_page_content') as mock_parse:
+            mock_parse.return_value = {'title': 'Busy', 'description': '', 'content': ''}
+            
+            await asyncio.gather(*(
+                extract_page_content(mock_client, f'https://busy.example.com/{i}')
+                for i in range(5)
+            ))
+        
+        assert mock_client.stream.call_count == 5
+        assert peak == 2
+    
+    async def test_host_semaphore_outlives_its_users(self):
+        """Test that a host entry is kept while in use and dropped afterwards."""
+        mock_client = make_client("<html><body><p>Text</p></body></html>")
+        mock_response = mock_client.stream.return_value.__aenter__.return_value
+        active = peak = 0
+        first_wave = asyncio.Event()
+        
+        async def enter_stream():
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            # The entry must survive while fetches hold or wait for it
+            assert 'busy.example.com' in server._host_semaphores
+            await first_wave.wait()
+            return mock_response
+        
+        async def exit_stream(*args):
+            nonlocal active
+            active -= 1
+        
+        mock_client.stream.return_value.__aenter__.side_effect = enter_stream
+        mock_client.stream.return_value.__aexit__.side_effect = exit_stream
+        
+        with patch('server.parse_page_content') as mock_parse:
+            mock_parse.return_value = {'title': 'Busy', 'description': '', 'content': ''}
+            
+            tasks = [
+                asyncio.create_task(extract_page_content(mock_client, f'https://busy.example.com/{i}'))
+                for i in range(5)
+            ]
+            await asyncio.sleep(0.01)
+            
+            # Two fetches are running, three are waiting for a slot
+            assert server._host_semaphores['busy.example.com'][1] == 5
+            first_wave.set()
+            await asyncio.gather(*tasks)
+        
+        assert peak == 2
+        assert server._host_semaphores == {}
+    
+    async def test_successful_extraction_is_cached(self):
+        """Test that a second extraction of the same URL skips the fetch."""
+        mock_client = make_client("<html><head><title>Cached</title></head><body><p>Text</p></body></html>")
+        
+        with patch('trafilatura.bare_extraction') as mock_extract:
+            mock_extract.return_value = None
+            
+            first = await extract_page_content(mock_client, 'https://example.com/cached')
+            second = await extract_page_content(mock_client, 'https://example.com/cached')
+            
+            assert first == second
+            assert first['title'] == 'Cached'
+            assert mock_client.stream.call_count == 1
+    
+    async def test_failed_extraction_is_not_cached(self):
+        """Test that failures are retried on the next extraction."""
+        mock_client = MagicMock()
+        mock_client.stream.side_effect = httpx.TimeoutException("Request timed out")
+        
+        await extract_page_content(mock_client, 'https://example.com/flaky')
+        await extract_page_content(mock_client, 'https://example.com/flaky')
+        
+        assert mock_client.stream.call_count == 2
@@ -2,21 +2,27 @@
 Tests for web search functionality.
 """
 import pytest
+import asyncio
 from unittest.mock import Mock, patch, AsyncMock
-import sys
-import os
 
-# Add src to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import diskcache
+import server
+from server import perform_search, parse_search_results
 
-from server import perform_search
+
+@pytest.fixture(autouse=True)
+def query_cache(tmp_path, monkeypatch):
+    """Give every test its own empty query cache."""
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(server, '_query_cache', cache)
+    yield cache
+    cache.close()
 
 
 @pytest.mark.unit
 class TestWebSearch:
     """Test suite for perform_search function."""
     
-    @pytest.mark.asyncio
     async def test_successful_search(self):
         """Test successful web search with mocked responses."""
         mock_search_html = """
@@ -32,17 +38,14 @@ class TestWebSearch:
         </html>
         """
         
-        with patch('server.httpx.Client') as mock_client_class:
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
-            
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             # Mock search results page
             mock_search_response = Mock()
             mock_search_response.text = mock_search_html
             mock_search_response.raise_for_status = Mock()
             
             # Mock individual page responses
-            def get_side_effect(url, headers):
+            def get_side_effect(url, **kwargs):
                 if 'duckduckgo' in url:
                     return mock_search_response
                 else:
@@ -53,28 +56,22 @@ class TestWebSearch:
             
             mock_client.get.side_effect = get_side_effect
             
-            with patch('server.extract_page_content') as mock_extract:
-                mock_extract.return_value = {
-                    'title': 'Test Title',
-                    'description': 'Test description',
-                    'content': 'Test content'
-                }
-                
+            with patch('server.extract_page_content', new=AsyncMock(return_value={
+                'title': 'Test Title',
+                'description': 'Test description',
+                'content': 'Test content'
+            })):
                 result = await perform_search('test query', max_results=2)
                 
                 assert 'Test Title' in result
                 assert 'https://example.com/1' in result
                 assert 'https://example.com/2' in result
     
-    @pytest.mark.asyncio
     async def test_search_with_no_results(self):
         """Test search when no results are found."""
         mock_html = "<html><body></body></html>"
         
-        with patch('server.httpx.Client') as mock_client_class:
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
-            
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             mock_response = Mock()
             mock_response.text = mock_html
             mock_response.raise_for_status = Mock()
@@ -84,7 +81,6 @@ class TestWebSearch:
             
             assert 'No results found' in result
     
-    @pytest.mark.asyncio
     async def test_search_with_max_results(self):
         """Test that max_results parameter is respected."""
         # Create HTML with 10 results
@@ -94,15 +90,12 @@ class TestWebSearch:
         ])
         mock_html = f"<html><body>{results_html}</body></html>"
         
-        with patch('server.httpx.Client') as mock_client_class:
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
-            
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             mock_search_response = Mock()
             mock_search_response.text = mock_html
             mock_search_response.raise_for_status = Mock()
             
-            def get_side_effect(url, headers):
+            def get_side_effect(url, **kwargs):
                 if 'duckduckgo' in url:
                     return mock_search_response
                 else:
@@ -113,13 +106,11 @@ class TestWebSearch:
             
             mock_client.get.side_effect = get_side_effect
             
-            with patch('server.extract_page_content') as mock_extract:
-                mock_extract.return_value = {
-                    'title': 'Title',
-                    'description': 'Desc',
-                    'content': 'Content'
-                }
-                
+            with patch('server.extract_page_content', new=AsyncMock(return_value={
+                'title': 'Title',
+                'description': 'Desc',
+                'content': 'Content'
+            })):
                 result = await perform_search('test', max_results=3)
                 
                 # Count occurrences of result markers
@@ -127,12 +118,9 @@ class TestWebSearch:
                 assert result_count >= 3
                 assert '[4]' not in result
     
-    @pytest.mark.asyncio
     async def test_search_error_handling(self):
         """Test proper error handling during search."""
-        with patch('server.httpx.Client') as mock_client_class:
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             mock_client.get.side_effect = Exception("Network error")
             
             result = await perform_search('test query')
@@ -140,15 +128,11 @@ class TestWebSearch:
             assert 'Error performing search' in result
             assert 'Network error' in result
     
-    @pytest.mark.asyncio
     async def test_search_url_encoding(self):
         """Test that query is properly URL encoded."""
         mock_html = "<html><body></body></html>"
         
-        with patch('server.httpx.Client') as mock_client_class:
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
-            
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             mock_response = Mock()
             mock_response.text = mock_html
             mock_response.raise_for_status = Mock()
@@ -161,15 +145,11 @@ class TestWebSearch:
             called_url = call_args[0][0]
             assert 'test+query' in called_url or 'test%20query' in called_url
     
-    @pytest.mark.asyncio
     async def test_search_with_region(self):
         """Test search with different region parameters."""
         mock_html = "<html><body></body></html>"
         
-        with patch('server.httpx.Client') as mock_client_class:
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
-            
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             mock_response = Mock()
             mock_response.text = mock_html
             mock_response.raise_for_status = Mock()
@@ -181,18 +161,168 @@ class TestWebSearch:
             
             assert 'No results found' in result  # Expected for empty HTML
 
+    
+    async def test_slow_page_is_dropped_after_deadline(self):
+        """Test that pages missing the extraction deadline get a timeout stub."""
+        mock_html = """
+        <div class="result"><a class="result__a" href="/?uddg=https://fast.example.com">Fast Result</a></div>
+        <div class="result"><a class="result__a" href="/?uddg=https://slow.example.com">Slow Result</a></div>
+        """
+        
+        async def fake_extract(client, url):
+            if 'slow' in url:
+                await asyncio.sleep(10)
+            return {'title': 'Fast Title', 'description': '', 'content': 'Fast content'}
+        
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client, \
+                patch('server.extract_page_content', side_effect=fake_extract), \
+                patch('server._EXTRACTION_DEADLINE', 0.05):
+            mock_response = Mock()
+            mock_response.text = mock_html
+            mock_response.raise_for_status = Mock()
+            mock_client.get.return_value = mock_response
+            
+            result = await perform_search('test', max_results=2)
+            
+            assert 'Fast content' in result
+            assert 'Slow Result' in result
+            assert '(timeout)' in result
+    
+    async def test_repeated_search_is_cached(self):
+        """Test that an identical search is answered from the query cache."""
+        mock_html = '<div class="result"><a class="result__a" href="/?uddg=https://example.com/1">First</a></div>'
+        
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
+            mock_response = Mock()
+            mock_response.text = mock_html
+            mock_response.raise_for_status = Mock()
+            mock_client.get.return_value = mock_response
+            
+            with patch('server.extract_page_content', new=AsyncMock(return_value={
+                'title': 'Cached Title',
+                'description': '',
+                'content': 'Cached content'
+            })):
+                first = await perform_search('cached query', max_results=1)
+                second = await perform_search('cached query', max_results=1)
+                
+                assert first == second
+                assert 'Cached Title' in second
+                assert mock_client.get.call_count == 1
+                
+                # Different parameters are a different cache entry
+                await perform_search('cached query', max_results=1, region='pl-pl')
+                assert mock_client.get.call_count == 2
+    
+    async def test_failed_search_is_not_cached(self):
+        """Test that errors are not stored in the query cache."""
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
+            mock_client.get.side_effect = Exception("Network error")
+            
+            await perform_search('failing query')
+            await perform_search('failing query')
+            
+            assert mock_client.get.call_count == 2
+    
+    def test_query_cache_opens_lazily_in_configured_dir(self, tmp_path, monkeypatch):
+        """Test that the query cache is opened on first use in WEBSEARCHMCP_CACHE_DIR."""
+        cache_dir = tmp_path / 'query-cache'
+        monkeypatch.setenv('WEBSEARCHMCP_CACHE_DIR', str(cache_dir))
+        monkeypatch.setattr(server, '_query_cache', None)
+        
+        cache = server._get_query_cache()
+        try:
+            assert cache.directory == str(cache_dir)
+            assert cache.timeout == server._QUERY_CACHE_TIMEOUT
+            assert server._get_query_cache() is cache
+        finally:
+            cache.close()
+    
+    async def test_search_survives_broken_query_cache(self, monkeypatch):
+        """Test that cache read/write errors do not fail the search."""
+        broken_cache = Mock()
+        broken_cache.get.side_effect = OSError("database is locked")
+        broken_cache.set.side_effect = OSError("disk full")
+        monkeypatch.setattr(server, '_query_cache', broken_cache)
+        
+        mock_html = '<div class="result"><a class="result__a" href="/?uddg=https://example.com/1">Result</a></div>'
+        
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
+            mock_response = Mock()
+            mock_response.text = mock_html
+            mock_response.raise_for_status = Mock()
+            mock_client.get.return_value = mock_response
+            
+            with patch('server.extract_page_content', new=AsyncMock(return_value={
+                'title': 'Fresh Title',
+                'description': '',
+                'content': 'Fresh content'
+            })):
+                result = await perform_search('uncached query', max_results=1)
+            
+            assert 'Fresh Title' in result
+            assert broken_cache.set.call_count == 1
+    
+    def test_parse_encoded_redirect_url(self):
+        """Test that percent-encoded uddg redirect targets are decoded."""
+        mock_html = """
+        <div class="result">
+            <a class="result__a" href="//duckduckgo.com/l/?uddg=https%3A%2F%2Fexample.com%2Fpage%3Fa%3D1%26b%3D2&amp;rut=abc">Encoded</a>
+        </div>
+        """
+        
+        results = parse_search_results(mock_html, max_results=5)
+        
+        assert results == [{'url': 'https://example.com/page?a=1&b=2', 'title': 'Encoded'}]
+
+    
+    def test_parse_skips_duplicate_urls(self):
+        """Test that duplicate result URLs are dropped without losing slots."""
+        mock_html = """
+        <div class="result"><a class="result__a" href="/?uddg=https://example.com/a">A</a></div>
+        <div class="result"><a class="result__a" href="/?uddg=https://example.com/a">A mirror</a></div>
+        <div class="result"><a class="result__a" href="/?uddg=https://example.com/b">B</a></div>
+        <div class="result"><a class="result__a" href="/?uddg=https://example.com/c">C</a></div>
+        """
+        
+        results = parse_search_results(mock_html, max_results=2)
+        
+        assert [r['url'] for r in results] == ['https://example.com/a', 'https://example.com/b']
+    
+    def test_parse_unescapes_titles(self):
+        """Test that entities and inline tags are removed from titles."""
+        mock_html = """
+        <div class="result">
+            <a rel="nofollow" class="result__a" href="/?uddg=https://example.com/q">Q&amp;A <b>about</b> Python</a>
+        </div>
+        """
+        
+        results = parse_search_results(mock_html, max_results=5)
+        
+        assert results == [{'url': 'https://example.com/q', 'title': 'Q&A about Python'}]
+    
+    def test_parse_falls_back_to_html_parser(self):
+        """Test that results are still found when the link regex does not match."""
+        mock_html = """
+        <div class="result">
+            <a href="/?uddg=https://example.com/new" class="result__a result__a--new">New markup</a>
+        </div>
+        """
+        
+        results = parse_search_results(mock_html, max_results=5)
+        
+        assert results == [{'url': 'https://example.com/new', 'title': 'New markup'}]
 
 @pytest.mark.integration
 class TestSearchIntegration:
     """Integration tests for search functionality."""
     
-    @pytest.mark.asyncio
     @pytest.mark.slow
     async def test_real_search_structure(self):
         """Test search returns properly structured results."""
         # This would be a real search in integration testing
         # For now, we mock it to verify structure
-        with patch('server.httpx.Client') as mock_client_class:
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client:
             mock_html = """
             <html>
                 <body>
@@ -203,26 +333,16 @@ class TestSearchIntegration:
             </html>
             """
             
-            mock_client = Mock()
-            mock_client_class.return_value.__enter__.return_value = mock_client
-            
             mock_search_response = Mock()
             mock_search_response.text = mock_html
             mock_search_response.raise_for_status = Mock()
+            mock_client.get.return_value = mock_search_response
             
-            mock_page_response = Mock()
-            mock_page_response.text = "<html><body><p>Content</p></body></html>"
-            mock_page_response.raise_for_status = Mock()
-            
-            mock_client.get.side_effect = [mock_search_response, mock_page_response]
-            
-            with patch('server.extract_page_content') as mock_extract:
-                mock_extract.return_value = {
-                    'title': 'Example Title',
-                    'description': 'Example description',
-                    'content': 'Example content'
-                }
-                
+            with patch('server.extract_page_content', new=AsyncMock(return_value={
+                'title': 'Example Title',
+                'description': 'Example description',
+                'content': 'Example content'
+            })):
                 result = await perform_search('test query')
                 
                 # Verify result structure
@@ -3,40 +3,83 @@ Tests for MCP server functionality.
 """
 import pytest
 from unittest.mock import Mock, patch, AsyncMock
-import sys
-import os
+import asyncio
+import inspect
 import json
+import os
+import re
+
+from server import server, handle_call_tool
+
+
+_MOCK_SEARCH_RESULT = """[1] Python Tutorial
+URL: https://example.com/python
+Description: Learn Python programming
+Content: Python is a high-level programming language...
+
+---
 
-# Add src to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+[2] Python Documentation
+URL: https://python.org/docs
+Description: Official Python docs
+Content: Welcome to the official Python documentation..."""
 
-from server import server, handle_list_tools, handle_call_tool
-import mcp.types as types
+_RE_MISSING_ARGS = re.compile("Missing arguments")
+_RE_MISSING_QUERY = re.compile("Missing 'query' argument")
+_RE_UNKNOWN_TOOL = re.compile("Unknown tool")
+
+
+class _RecSend:
+    """ASGI send callable recording every message."""
+    
+    def __init__(self):
+        self.calls = []
+    
+    async def __call__(self, message):
+        self.calls.append(message)
+
+
+class _RecRecv:
+    """ASGI receive callable returning the given messages, then an empty request."""
+    
+    def __init__(self, *messages):
+        self.messages = list(messages)
+    
+    async def __call__(self):
+        if self.messages:
+            return self.messages.pop(0)
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+
+@pytest.fixture
+def asgi_harness():
+    """Factory building (send, receive, scope) for a request to the ASGI app."""
+    def _mk(scope_overrides):
+        scope = {'type': 'http', 'path': '/', 'method': 'GET', **scope_overrides}
+        return _RecSend(), _RecRecv(), scope
+    return _mk
 
 
 @pytest.mark.unit
 class TestMCPServer:
     """Test suite for MCP server handlers."""
     
-    @pytest.mark.asyncio
-    async def test_list_tools(self):
+    @pytest.fixture(autouse=True)
+    def _patched_search(self, mock_search):
+        """Patch perform_search once for every test in the class."""
+        self._mock_search = mock_search
+    
+    async def test_list_tools(self, tools_list, tools_by_name, search_tool):
         """Test that list_tools returns the search_web tool."""
-        tools = await handle_list_tools()
+        assert len(tools_list) > 0
+        assert 'search_web' in tools_by_name
         
-        assert len(tools) > 0
-        assert any(tool.name == 'search_web' for tool in tools)
-        
-        search_tool = next(tool for tool in tools if tool.name == 'search_web')
         assert search_tool.description is not None
         assert 'query' in search_tool.inputSchema['properties']
         assert search_tool.inputSchema['required'] == ['query']
     
-    @pytest.mark.asyncio
-    async def test_list_tools_schema(self):
+    async def test_list_tools_schema(self, search_tool):
         """Test that search_web tool has correct schema."""
-        tools = await handle_list_tools()
-        search_tool = next(tool for tool in tools if tool.name == 'search_web')
-        
         schema = search_tool.inputSchema
         properties = schema['properties']
         
@@ -53,130 +96,77 @@ class TestMCPServer:
         assert properties['max_results']['default'] == 5
         assert properties['region']['default'] == 'wt-wt'
     
-    @pytest.mark.asyncio
-    async def test_call_tool_search_web_success(self):
-        """Test successful call to search_web tool."""
-        arguments = {
-            'query': 'test query',
-            'max_results': 3
-        }
-        
-        with patch('server.perform_search') as mock_search:
-            mock_search.return_value = "Mocked search results"
-            
-            result = await handle_call_tool('search_web', arguments)
-            
-            assert len(result) == 1
-            assert isinstance(result[0], types.TextContent)
-            assert result[0].text == "Mocked search results"
-            
-            mock_search.assert_called_once_with(
-                query='test query',
-                max_results=3,
-                region='wt-wt',
-                timelimit=None
-            )
-    
-    @pytest.mark.asyncio
-    async def test_call_tool_with_all_parameters(self):
-        """Test call_tool with all optional parameters."""
-        arguments = {
-            'query': 'test',
-            'max_results': 10,
-            'region': 'pl-pl',
-            'timelimit': 'w'
-        }
-        
-        with patch('server.perform_search') as mock_search:
-            mock_search.return_value = "Results"
-            
-            result = await handle_call_tool('search_web', arguments)
-            
-            mock_search.assert_called_once_with(
-                query='test',
-                max_results=10,
-                region='pl-pl',
-                timelimit='w'
-            )
-    
-    @pytest.mark.asyncio
-    async def test_call_tool_missing_arguments(self):
-        """Test that missing arguments raises ValueError."""
-        with pytest.raises(ValueError, match="Missing arguments"):
-            await handle_call_tool('search_web', None)
-    
-    @pytest.mark.asyncio
-    async def test_call_tool_missing_query(self):
-        """Test that missing query raises ValueError."""
-        arguments = {'max_results': 5}
-        
-        with pytest.raises(ValueError, match="Missing 'query' argument"):
-            await handle_call_tool('search_web', arguments)
-    
-    @pytest.mark.asyncio
-    async def test_call_tool_unknown_tool(self):
-        """Test that unknown tool name raises ValueError."""
-        with pytest.raises(ValueError, match="Unknown tool"):
-            await handle_call_tool('nonexistent_tool', {'query': 'test'})
-    
-    @pytest.mark.asyncio
-    async def test_call_tool_default_parameters(self):
-        """Test that default parameters are applied correctly."""
-        arguments = {'query': 'test'}
-        
-        with patch('server.perform_search') as mock_search:
-            mock_search.return_value = "Results"
-            
-            await handle_call_tool('search_web', arguments)
-            
-            # Verify defaults were used
-            call_kwargs = mock_search.call_args[1]
-            assert call_kwargs['max_results'] == 5
-            assert call_kwargs['region'] == 'wt-wt'
-            assert call_kwargs['timelimit'] is None
+    @pytest.mark.parametrize("name, args, expected_kwargs, raises", [
+        # Explicit max_results, defaults for the rest
+        ('search_web',
+         {'query': 'test query', 'max_results': 3},
+         {'query': 'test query', 'max_results': 3, 'region': 'wt-wt', 'timelimit': None},
+         None),
+        # All optional parameters passed through
+        ('search_web',
+         {'query': 'test', 'max_results': 10, 'region': 'pl-pl', 'timelimit': 'w'},
+         {'query': 'test', 'max_results': 10, 'region': 'pl-pl', 'timelimit': 'w'},
+         None),
+        # Only the query, every default applied
+        ('search_web',
+         {'query': 'test'},
+         {'query': 'test', 'max_results': 5, 'region': 'wt-wt', 'timelimit': None},
+         None),
+        ('search_web', None, None, (ValueError, _RE_MISSING_ARGS)),
+        ('search_web', {'max_results': 5}, None, (ValueError, _RE_MISSING_QUERY)),
+        ('nonexistent_tool', {'query': 'test'}, None, (ValueError, _RE_UNKNOWN_TOOL)),
+    ], ids=[
+        'success',
+        'all_parameters',
+        'default_parameters',
+        'missing_arguments',
+        'missing_query',
+        'unknown_tool',
+    ])
+    async def test_call_tool(self, name, args, expected_kwargs, raises):
+        """Test call_tool arguments handling and error reporting."""
+        if raises:
+            exc_type, match = raises
+            with pytest.raises(exc_type, match=match):
+                await handle_call_tool(name, args)
+            self._mock_search.assert_not_called()
+            return
+        
+        result = await handle_call_tool(name, args)
+        
+        assert len(result) == 1
+        assert result[0].type == 'text'
+        assert result[0].text == "Mocked search results"
+        
+        self._mock_search.assert_called_once_with(**expected_kwargs)
 
 
 @pytest.mark.integration
 class TestMCPServerIntegration:
     """Integration tests for MCP server."""
     
-    @pytest.mark.asyncio
-    async def test_full_search_workflow(self):
+    @pytest.mark.slow
+    async def test_full_search_workflow(self, tools_by_name, server_mod, monkeypatch):
         """Test complete workflow from tool call to result."""
         arguments = {
             'query': 'Python programming',
             'max_results': 2
         }
         
-        mock_search_result = """[1] Python Tutorial
-URL: https://example.com/python
-Description: Learn Python programming
-Content: Python is a high-level programming language...
-
----
-
-[2] Python Documentation
-URL: https://python.org/docs
-Description: Official Python docs
-Content: Welcome to the official Python documentation..."""
+        monkeypatch.setattr(server_mod, 'perform_search', AsyncMock(return_value=_MOCK_SEARCH_RESULT))
         
-        with patch('server.perform_search') as mock_search:
-            mock_search.return_value = mock_search_result
-            
-            # First, verify tool is listed
-            tools = await handle_list_tools()
-            assert any(t.name == 'search_web' for t in tools)
-            
-            # Then call the tool
-            result = await handle_call_tool('search_web', arguments)
-            
-            # Verify result structure
-            assert len(result) == 1
-            assert result[0].type == 'text'
-            assert 'Python Tutorial' in result[0].text
-            assert 'https://example.com/python' in result[0].text
+        # First, verify tool is listed
+        assert 'search_web' in tools_by_name
+        
+        # Then call the tool
+        result = await handle_call_tool('search_web', arguments)
+        
+        # Verify result structure
+        assert len(result) == 1
+        assert result[0].type == 'text'
+        assert 'Python Tutorial' in result[0].text
+        assert 'https://example.com/python' in result[0].text
     
-    @pytest.mark.asyncio
     async def test_server_initialization(self):
         """Test that server is properly initialized."""
         # Verify server object exists and has correct name
@@ -189,47 +179,68 @@ Content: Welcome to the official Python documentation..."""
 class TestASGIApplication:
     """Tests for ASGI application endpoints."""
     
-    @pytest.mark.asyncio
-    async def test_asgi_app_structure(self):
+    async def test_asgi_app_structure(self, server_mod):
         """Test that ASGI app is properly defined."""
-        from server import app
+        app = server_mod.app
         
         # Verify app is a coroutine function
-        import inspect
         assert inspect.iscoroutinefunction(app)
     
-    @pytest.mark.asyncio
-    async def test_invalid_scope_type(self):
+    async def test_invalid_scope_type(self, server_mod, asgi_harness):
         """Test that non-HTTP requests are ignored."""
-        from server import app
+        app = server_mod.app
         
-        scope = {'type': 'websocket', 'path': '/', 'method': 'GET'}
-        receive = AsyncMock()
-        send = AsyncMock()
+        send, receive, scope = asgi_harness({'type': 'websocket'})
         
         # Should return early without error
         await app(scope, receive, send)
         
         # Send should not be called for non-HTTP
-        send.assert_not_called()
+        assert not send.calls
     
-    @pytest.mark.asyncio
-    async def test_404_response(self):
+    async def test_404_response(self, server_mod, asgi_harness):
         """Test 404 response for unknown paths."""
-        from server import app
+        app = server_mod.app
         
-        scope = {
-            'type': 'http',
-            'path': '/unknown',
-            'method': 'GET'
-        }
-        receive = AsyncMock()
-        send = AsyncMock()
+        send, receive, scope = asgi_harness({'path': '/unknown'})
         
         await app(scope, receive, send)
         
         # Verify 404 response was sent
-        assert send.call_count >= 2
-        start_call = send.call_args_list[0][0][0]
+        assert len(send.calls) >= 2
+        start_call = send.calls[0]
         assert start_call['type'] == 'http.response.start'
         assert start_call['status'] == 404
+    
+    async def test_lifespan_closes_http_client(self, server_mod):
+        """Test that lifespan sizes the thread pool and closes the HTTP client and cache."""
+        app = server_mod.app
+        
+        scope = {'type': 'lifespan'}
+        receive = _RecRecv(
+            {'type': 'lifespan.startup'},
+            {'type': 'lifespan.shutdown'}
+        )
+        send = _RecSend()
+        
+        # Keep the shared session loop's real executor out of the test
+        loop = asyncio.get_running_loop()
+        previous_executor = Mock()
+        
+        with patch('server.http_client', new_callable=AsyncMock) as mock_client, \
+                patch('server._query_cache') as mock_cache, \
+                patch('server.ThreadPoolExecutor') as mock_executor_cls, \
+                patch.object(loop, '_default_executor', previous_executor), \
+                patch.object(loop, 'set_default_executor') as mock_set_executor:
+            await app(scope, receive, send)
+            
+            mock_executor_cls.assert_called_once_with(
+                max_workers=min(32, (os.cpu_count() or 1) * 2)
+            )
+            mock_set_executor.assert_called_once_with(mock_executor_cls.return_value)
+            previous_executor.shutdown.assert_called_once_with(wait=False)
+            mock_client.aclose.assert_awaited_once()
+            mock_cache.close.assert_called_once()
+        
+        sent_types = [message['type'] for message in send.calls]
+        assert sent_types == ['lifespan.startup.complete', 'lifespan.shutdown.complete']